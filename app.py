@@ -1,6 +1,6 @@
 from flask import Flask, request, abort
 from twilio.twiml.messaging_response import MessagingResponse
-import os, logging, re, json, random, string
+import os, logging, re, json, random, string, time, threading, zlib
 import requests # <--- הוספנו את ספריית requests
 from requests.exceptions import RequestException # <--- לטיפול שגיאות רשת
 
@@ -12,32 +12,75 @@ log = logging.getLogger("budget-queen")
 app = Flask(__name__)
 
 # ===== Redis (persistent state) =====
+# החיבור נוצר בעצלות, בפעם הראשונה שצריך אותו (ולא ב-import), ומחדש אחרי fork
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_RETRY_SEC = int(os.getenv("REDIS_RETRY_SEC", "30"))
 USE_REDIS = False
 r = None
-try:
+r_bin = None               # same server, raw bytes (compressed cold trips)
+_redis_lock = threading.Lock()
+_redis_pid = None          # pid of the process that built `r`
+_redis_next_try = 0.0      # no reconnect attempts before this (unix ts)
+
+def _connect_redis(decode_responses=True):
     from redis import Redis
-    REDIS_URL = os.getenv("REDIS_URL")
-    if REDIS_URL:
-        r = Redis.from_url(
-            REDIS_URL,
-            decode_responses=True,
-            socket_connect_timeout=5,
-            socket_timeout=5,
-            health_check_interval=30,
-            retry_on_timeout=True,
-        )
+    return Redis.from_url(
+        REDIS_URL,
+        decode_responses=decode_responses,
+        socket_connect_timeout=5,
+        socket_timeout=5,
+        health_check_interval=30,
+        retry_on_timeout=True,
+    )
+
+def redis_client():
+    """
+    Returns the Redis client for this process, or None when running in-memory.
+    Connects on first use and after fork; after a failure, retries at most
+    every REDIS_RETRY_SEC instead of on every request.
+    """
+    global r, r_bin, USE_REDIS, _redis_pid, _redis_next_try
+    pid = os.getpid()
+    if _redis_pid == pid:
+        if USE_REDIS:
+            return r
+        if time.time() < _redis_next_try:
+            return None
+        # התחברות מחדש: רק thread אחד מנסה, השאר ממשיכים בזיכרון בינתיים
+        if not _redis_lock.acquire(blocking=False):
+            return None
+    else:
+        # התחברות ראשונה בתהליך הזה: מחכים לה, כדי לא לכתוב לזיכרון בטעות
+        if not REDIS_URL:
+            return None
+        _redis_lock.acquire()
+    try:
+        if _redis_pid == pid and (USE_REDIS or time.time() < _redis_next_try):
+            return r if USE_REDIS else None
         try:
+            r = _connect_redis()
             r.ping()
+            r_bin = _connect_redis(decode_responses=False)
             USE_REDIS = True
             log.info("Redis enabled ✅")
         except Exception as e:
-            r = None
+            r = r_bin = None
             USE_REDIS = False
-            log.warning("Redis ping failed; falling back to in-memory ⚠️ %s", e)
-    else:
-        log.warning("REDIS_URL not set; falling back to in-memory state ⚠️")
-except Exception as e:
-    log.warning("Redis import failed; using in-memory state ⚠️ %s", e)
+            _redis_next_try = time.time() + REDIS_RETRY_SEC
+            log.warning("Redis unavailable; falling back to in-memory ⚠️ %s", e)
+        _redis_pid = pid
+        return r
+    finally:
+        _redis_lock.release()
+
+def redis_failed(e):
+    # תקלה באמצע בקשה: עוברים לזיכרון ומנסים להתחבר שוב אחרי REDIS_RETRY_SEC
+    # בלי _redis_lock: לא מחכים ל-thread שבאמצע התחברות מחדש
+    global USE_REDIS, _redis_next_try
+    if USE_REDIS:
+        log.warning("Redis temporarily unavailable; continuing in-memory ⚠️ %s", e)
+    _redis_next_try = time.time() + REDIS_RETRY_SEC
+    USE_REDIS = False
 
 # ===== Constants =====
 # אלו עכשיו משמשים רק כגיבוי (Fallback)
@@ -74,9 +117,43 @@ CATEGORY_MAP = {
     "סים": "תקשורת", "טלפון": "תקשורת", "חבילת גלישה": "תקשורת", "wifi": "תקשורת",
 }
 
+# טבלאות מילות מפתח מוכנות מראש (lowercase), כדי לא לחשב אותן בכל הודעה
+ALIAS_ITEMS = tuple((k.lower(), v) for k, v in ALIASES.items())
+CATEGORY_ITEMS = tuple((k.lower(), v) for k, v in CATEGORY_MAP.items())
+
+# ===== Precompiled patterns (hot path) =====
+RE_AMOUNT = re.compile(r"(\d[\d,\.]*)")
+RE_TRIP_CODE = re.compile(r"\b([A-Za-z0-9]{4,10})\b")
+RE_NORM_PUNCT = re.compile(r"[^\w\u0590-\u05FF ]+")
+RE_SPACES = re.compile(r"\s+")
+RE_DIGITS = re.compile(r"\d+")
+RE_EXPENSE_PREFIX = re.compile(r"^הוצאה[:\s]*", re.IGNORECASE)
+RE_DESC_CURRENCY = re.compile(r"^[\s\-–:.,]*(דולר|יורו|אירו|שקל|ש\"ח|₪|\$|€)?[\s\-–:.,]*", re.IGNORECASE)
+RE_OPEN_GROUP_PREFIX = re.compile(r"^פתח קבוצה[:\s]*")
+RE_NAME_FOR_NUMBER = re.compile(r"שם\s+(\+?\d+)\s*:\s*(.+)$")
+RE_LIST_SPLIT = re.compile(r"[,\n]")
+RE_RATE_PAIRS = re.compile(r"(USD|EUR|ILS)\s*=\s*([\d\.]+)", re.IGNORECASE)
+RE_DEST_PREFIX = re.compile(r"^יעד[:\s]*", re.IGNORECASE)
+RE_BUDGET_PREFIX = re.compile(r"^תקציב[:\s]*", re.IGNORECASE)
+
 # ===== In-memory fallback =====
-MEM_TRIPS = {}    # key -> trip state
-MEM_USERS = {}    # phone -> user meta
+# נשמר כ-JSON (כמו ב-Redis) כדי שבקשות מקבילות ב-threads לא ישתפו את אותו dict
+MEM_LOCK = threading.RLock()   # guards every MEM_* dict
+MEM_TRIPS = {}    # key -> trip state (JSON)
+MEM_USERS = {}    # phone -> user meta (JSON)
+MEM_COLD = {}     # trip code -> compressed trip state (zlib bytes)
+MEM_SEEN = {}     # trip code -> last activity (unix ts)
+
+# ===== Cold-trip archival =====
+# טיולים שלא נגעו בהם X ימים עוברים לאחסון דחוס, וחוזרים אוטומטית ב-load_trip.
+# טיול אישי שלא נגעו בו בכלל (ברירת מחדל) פשוט נמחק — ensure_self_trip יוצר אותו מחדש.
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "30"))
+ARCHIVE_INTERVAL_SEC = int(os.getenv("ARCHIVE_INTERVAL_SEC", "3600"))  # 0 = disabled
+ACTIVITY_KEY = "trips:last_seen"   # zset: trip code -> last activity (unix ts)
+ARCHIVER_LOCK_KEY = "archiver:lock"
+BACKFILL_DONE_KEY = "trips:last_seen:backfilled"
+COLD_BUCKETS = int(os.getenv("COLD_BUCKETS", "1024"))  # hashes "trips:cold:{n}", field = trip code
+ARCHIVE_PAGE_SIZE = 500
 
 # ===== פונקציה חדשה להבאת שערים חיים =====
 def fetch_live_rates():
@@ -118,19 +195,36 @@ def fetch_live_rates():
         return DEFAULT_RATES.copy()
 # ==========================================
 
+# ===== FX cache =====
+# שערים חיים נשמרים בזיכרון של ה-worker, כדי לא לפנות ל-API בכל טיול חדש
+FX_TTL_SEC = int(os.getenv("FX_TTL_SEC", "3600"))
+FX_RETRY_SEC = 60   # after a failed fetch (defaults served), retry sooner
+_fx_lock = threading.Lock()
+_fx_cache = {"rates": None, "expires": 0.0}
+
+def get_rates():
+    """
+    Returns live rates from the per-process cache, fetching them when stale.
+    The lock makes concurrent threads wait for a single fetch.
+    """
+    with _fx_lock:
+        if _fx_cache["rates"] is None or time.time() >= _fx_cache["expires"]:
+            rates = fetch_live_rates()
+            ttl = FX_TTL_SEC if rates != DEFAULT_RATES else FX_RETRY_SEC
+            _fx_cache["rates"], _fx_cache["expires"] = rates, time.time() + ttl
+        return dict(_fx_cache["rates"])
+
 
 def default_state():
-    log.info("Creating default state, fetching live rates...")
-    # --- שינוי ---
-    # במקום להשתמש בערך הקבוע, אנו קוראים לפונקציה החדשה
-    live_rates = fetch_live_rates() 
-    # -------------
+    log.info("Creating default state...")
+    live_rates = get_rates()
     return {
         "budget": 0,
         "remaining": 0,
         "destination": "",
         "expenses": [],  # {amt_ils:int, desc:str, cat:str, added_by:str}
         "rates": live_rates, # <--- משתמשים בשערים המעודכנים
+        "rates_custom": False,  # True once the user sets a rate by hand ("שער:")
         "display_currency": "ILS",
         "members": [],
         "names": {},    # phone -> name
@@ -145,6 +239,8 @@ def tw_reply(text: str):
 # ===== Trip/User keys =====
 def trip_key(code): return f"trip:{code}"
 def user_key(num): return f"user:{num}"
+def trip_lock_key(code): return f"lock:trip:{code}"
+def cold_bucket(code): return f"trips:cold:{zlib.crc32(code.encode('utf-8')) % COLD_BUCKETS}"
 
 def random_code(n=6):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(n))
@@ -152,43 +248,340 @@ def random_code(n=6):
 # ===== Trip/User persistence =====
 def trip_exists(code):
     key = trip_key(code)
-    if USE_REDIS:
-        try: return bool(r.exists(key))
-        except: return False
-    return key in MEM_TRIPS
+    rc = redis_client()
+    if rc is not None:
+        try: return bool(rc.exists(key)) or bool(rc.hexists(cold_bucket(code), code))
+        except Exception as e:
+            redis_failed(e)
+            return False
+    with MEM_LOCK:
+        return key in MEM_TRIPS or code in MEM_COLD
 
 def load_trip(code):
     key = trip_key(code)
-    if USE_REDIS:
+    rc = redis_client()
+    if rc is not None:
         try:
-            raw = r.get(key)
+            raw = rc.get(key)
             if raw: return json.loads(raw)
+            return rehydrate_trip(code, rc)
+        except Exception as e:
+            redis_failed(e)
             return None
-        except: return None
-    return MEM_TRIPS.get(key)
+    with MEM_LOCK:
+        raw = MEM_TRIPS.get(key)
+    if raw is not None: return json.loads(raw)
+    return rehydrate_trip(code, None)
 
 def save_trip(code, st):
     key = trip_key(code)
-    if USE_REDIS:
-        try: r.set(key, json.dumps(st)); return
-        except Exception as e: log.warning("Redis write failed for trip %s: %s", code, e)
-    MEM_TRIPS[key] = st
+    raw = json.dumps(st)
+    rc = redis_client()
+    if rc is not None:
+        try:
+            # HDEL: אם הארכיון הספיק להעביר את הטיול בזמן הבקשה — לא משאירים עותק ישן
+            pipe = rc.pipeline(transaction=False)
+            pipe.set(key, raw).zadd(ACTIVITY_KEY, {code: time.time()}).hdel(cold_bucket(code), code)
+            pipe.execute()
+            return
+        except Exception as e:
+            log.warning("Redis write failed for trip %s: %s", code, e)
+            redis_failed(e)
+    with MEM_LOCK:
+        MEM_TRIPS[key] = raw
+        MEM_SEEN[code] = time.time()
+        MEM_COLD.pop(code, None)
+
+# ===== Cold storage (compressed) =====
+def compress_state(raw: str) -> bytes:
+    return zlib.compress(raw.encode("utf-8"), 9)
+
+def decompress_state(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+def is_untouched_self_trip(code, st):
+    # טיול אישי במצב ברירת מחדל — אין בו שום דבר ששווה לשמור.
+    # טיולים ישנים בלי rates_custom לא נחשבים "נקיים" (אולי שינו בהם שער) — הם נכנסים לארכיון.
+    return (
+        code.startswith("SELF:")
+        and st.get("code") == code
+        and st.get("rates_custom") is False
+        and not st.get("budget") and not st.get("remaining")
+        and not st.get("expenses") and not st.get("destination")
+        and st.get("display_currency", "ILS") == "ILS"
+        and len(st.get("members", [])) <= 1
+        and all(n == "אני" for n in st.get("names", {}).values())
+    )
+
+def rehydrate_trip(code, rc):
+    """
+    Moves an archived trip back into the hot keyspace (`rc` is the Redis
+    client the caller already holds, or None in memory mode).
+    Returns the trip state, or None if nothing is archived under this code.
+    """
+    if rc is not None:
+        key, bucket = trip_key(code), cold_bucket(code)
+        rb = r_bin
+        if rb is None: raise RuntimeError("Redis binary client unavailable")
+        blob = rb.hget(bucket, code)
+        if blob is None: return None
+        raw = decompress_state(blob)
+        # NX: אם בקשה אחרת כבר החזירה (ואולי שמרה) את הטיול — לא דורסים אותה
+        if rc.set(key, raw, nx=True):
+            rc.pipeline(transaction=False).hdel(bucket, code).zadd(ACTIVITY_KEY, {code: time.time()}).execute()
+            log.info("Rehydrated archived trip %s", code)
+        else:
+            rc.hdel(bucket, code)
+            raw = rc.get(key)
+            if raw is None: return None
+        return json.loads(raw)
+    with MEM_LOCK:
+        blob = MEM_COLD.pop(code, None)
+        if blob is None: return None
+        raw = decompress_state(blob)
+        MEM_TRIPS[trip_key(code)] = raw
+        MEM_SEEN[code] = time.time()
+    log.info("Rehydrated archived trip %s", code)
+    return json.loads(raw)
+
+def _key_bytes(rc, key, fallback):
+    # MEMORY USAGE לא זמין בכל ספק Redis; במקרה כזה מעריכים לפי אורך הערך
+    try: return int(rc.memory_usage(key, samples=0) or fallback)
+    except Exception: return fallback
+
+def _backfill_activity(rc):
+    # טיולים שנשמרו לפני שהתחלנו לעקוב אחרי פעילות — השעון שלהם מתחיל עכשיו (פעם אחת)
+    if rc.exists(BACKFILL_DONE_KEY):
+        return
+    now = time.time()
+    pipe = rc.pipeline(transaction=False)
+    for i, key in enumerate(rc.scan_iter(match="trip:*", count=500), start=1):
+        pipe.zadd(ACTIVITY_KEY, {key[len("trip:"):]: now}, nx=True)
+        if i % 500 == 0:
+            pipe.execute()
+    pipe.execute()
+    rc.set(BACKFILL_DONE_KEY, "1")
+
+def _archive_one(rc, code, cutoff):
+    """
+    Archives (or deletes, if untouched) a single idle trip in Redis.
+    Returns (outcome, reclaimed_bytes); outcome is "archived", "deleted",
+    "gone" (no longer idle / no hot key) or "skipped" (changed meanwhile).
+    """
+    from redis.exceptions import WatchError
+    key, bucket = trip_key(code), cold_bucket(code)
+    ukey = user_key(code[len("SELF:"):]) if code.startswith("SELF:") else None
+    with rc.pipeline() as pipe:
+        try:
+            # WATCH: אם מישהו שומר את הטיול באמצע — מוותרים עליו בסבב הזה
+            pipe.watch(key, *([ukey] if ukey else []))
+            raw = pipe.get(key)
+            if raw is None:
+                pipe.zrem(ACTIVITY_KEY, code)
+                return "gone", 0
+            score = pipe.zscore(ACTIVITY_KEY, code)
+            if score is not None and score > cutoff:
+                return "gone", 0
+            freed = _key_bytes(rc, key, len(raw.encode("utf-8")))
+            if is_untouched_self_trip(code, json.loads(raw)):
+                uraw = pipe.get(ukey)
+                drop_user = uraw is not None and json.loads(uraw) == {"active_trip": code}
+                if drop_user:
+                    freed += _key_bytes(rc, ukey, len(uraw.encode("utf-8")))
+                pipe.multi()
+                pipe.delete(key, *([ukey] if drop_user else [])).zrem(ACTIVITY_KEY, code)
+                pipe.execute()
+                return "deleted", freed
+            blob = compress_state(raw)
+            bucket_before = _key_bytes(rc, bucket, 0)
+            pipe.multi()
+            pipe.hset(bucket, code, blob).delete(key).zrem(ACTIVITY_KEY, code)
+            pipe.execute()
+        except WatchError:
+            return "skipped", 0
+    return "archived", freed - (_key_bytes(rc, bucket, bucket_before + len(code) + len(blob)) - bucket_before)
+
+def archive_idle_trips(idle_days=None):
+    """
+    Handles trips with no activity for `idle_days` (default ARCHIVE_IDLE_DAYS):
+    untouched SELF trips are deleted, the rest are zlib-compressed into the
+    "trips:cold:{n}" hashes and their hot key is dropped.
+    Returns {"archived": int, "deleted": int, "reclaimed_bytes": int}.
+    """
+    idle_days = ARCHIVE_IDLE_DAYS if idle_days is None else idle_days
+    cutoff = time.time() - idle_days * 86400
+    archived, deleted, reclaimed = 0, 0, 0
+
+    rc = redis_client()
+    if rc is not None:
+        _backfill_activity(rc)
+        # עוברים בדפים: טיולים שטופלו יוצאים מה-zset, ולכן ה-offset גדל רק על מה שדילגנו
+        offset = 0
+        while True:
+            page = rc.zrangebyscore(ACTIVITY_KEY, "-inf", cutoff, start=offset, num=ARCHIVE_PAGE_SIZE)
+            if not page:
+                break
+            for code in page:
+                outcome, freed = _archive_one(rc, code, cutoff)
+                if outcome == "skipped":
+                    offset += 1
+                archived += outcome == "archived"
+                deleted += outcome == "deleted"
+                reclaimed += freed
+    else:
+        now = time.time()
+        with MEM_LOCK:
+            candidates = [(key, raw) for key, raw in MEM_TRIPS.items()
+                          if MEM_SEEN.setdefault(key[len("trip:"):], now) <= cutoff]
+        # דחיסה מחוץ ל-MEM_LOCK, כדי לא לעצור בקשות; ההחלפה עצמה שוב תחת הנעילה
+        for key, raw in candidates:
+            code = key[len("trip:"):]
+            untouched = is_untouched_self_trip(code, json.loads(raw))
+            blob = None if untouched else compress_state(raw)
+            with MEM_LOCK:
+                if MEM_TRIPS.get(key) is not raw or MEM_SEEN.get(code, now) > cutoff:
+                    continue   # saved meanwhile
+                del MEM_TRIPS[key]
+                MEM_SEEN.pop(code, None)
+                if untouched:
+                    ukey = user_key(code[len("SELF:"):])
+                    uraw = MEM_USERS.get(ukey)
+                    if uraw is not None and json.loads(uraw) == {"active_trip": code}:
+                        del MEM_USERS[ukey]
+                        reclaimed += len(uraw.encode("utf-8"))
+                    deleted += 1
+                    reclaimed += len(raw.encode("utf-8"))
+                    continue
+                MEM_COLD[code] = blob
+            archived += 1
+            reclaimed += len(raw.encode("utf-8")) - len(blob)
+
+    log.info("Archiver: archived %d idle trips, deleted %d untouched SELF trips, reclaimed ~%d bytes",
+             archived, deleted, reclaimed)
+    return {"archived": archived, "deleted": deleted, "reclaimed_bytes": reclaimed}
+
+def _archiver_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_SEC)
+        try:
+            # כמה workers של gunicorn — רק אחד מריץ סבב בכל פעם
+            rc = redis_client()
+            if rc is not None and not rc.set(ARCHIVER_LOCK_KEY, "1", nx=True, ex=ARCHIVE_INTERVAL_SEC):
+                continue
+            archive_idle_trips()
+        except Exception as e:
+            log.warning("Archiver run failed: %s", e)
+
+def start_archiver():
+    if ARCHIVE_INTERVAL_SEC <= 0:
+        log.info("Trip archiver disabled (ARCHIVE_INTERVAL_SEC=0)")
+        return
+    threading.Thread(target=_archiver_loop, name="trip-archiver", daemon=True).start()
+    log.info("Trip archiver started (idle=%sd, every %ss)", ARCHIVE_IDLE_DAYS, ARCHIVE_INTERVAL_SEC)
 
 def load_user(num):
     key = user_key(num)
-    if USE_REDIS:
+    rc = redis_client()
+    if rc is not None:
         try:
-            raw = r.get(key)
+            raw = rc.get(key)
             if raw: return json.loads(raw)
-        except: pass
-    return MEM_USERS.get(key, {"active_trip": f"SELF:{num}"})
+        except Exception as e: redis_failed(e)
+    with MEM_LOCK:
+        raw = MEM_USERS.get(key)
+    return json.loads(raw) if raw else {"active_trip": f"SELF:{num}"}
 
 def save_user(num, meta):
     key = user_key(num)
-    if USE_REDIS:
-        try: r.set(key, json.dumps(meta)); return
-        except: pass
-    MEM_USERS[key] = meta
+    raw = json.dumps(meta)
+    rc = redis_client()
+    if rc is not None:
+        try: rc.set(key, raw); return
+        except Exception as e: redis_failed(e)
+    with MEM_LOCK:
+        MEM_USERS[key] = raw
+
+# ===== Per-trip locking =====
+# load → שינוי → save של אותו טיול לא רצים במקביל (threads באותו worker, ו-workers שונים דרך Redis)
+TRIP_LOCK_WAIT_SEC = 5.0
+TRIP_LOCK_TTL_MS = 10000   # Redis lock expiry, in case a worker dies while holding it
+_trip_lock_stripes = [threading.RLock() for _ in range(256)]
+_trip_locks_held = threading.local()
+# מוחקים רק אם הנעילה עדיין שלנו (אולי פגה ונלקחה ע"י מישהו אחר) — סבב אחד ל-Redis
+_UNLOCK_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+class TripLock:
+    """
+    Serializes the read-modify-write of one trip. A striped process-local
+    lock covers threads in this worker; with Redis, a SET NX lock covers
+    the other workers. Re-entrant per thread for the same trip code.
+    """
+    def __init__(self, code):
+        self.code = code
+        self._local = _trip_lock_stripes[zlib.crc32(code.encode("utf-8")) % len(_trip_lock_stripes)]
+        self._rc = self._token = None
+        self._nested = False
+
+    def acquire(self):
+        held = _trip_locks_held.__dict__.setdefault("codes", set())
+        if self.code in held:
+            self._nested = True
+            return self
+        deadline = time.time() + TRIP_LOCK_WAIT_SEC
+        if not self._local.acquire(timeout=TRIP_LOCK_WAIT_SEC):
+            raise TimeoutError(f"trip {self.code} is busy")
+        rc = redis_client()
+        if rc is not None:
+            token = os.urandom(8).hex()
+            try:
+                while not rc.set(trip_lock_key(self.code), token, nx=True, px=TRIP_LOCK_TTL_MS):
+                    if time.time() >= deadline:
+                        self._local.release()
+                        raise TimeoutError(f"trip {self.code} is busy")
+                    time.sleep(0.01)
+                self._rc, self._token = rc, token
+            except TimeoutError:
+                raise
+            except Exception as e:
+                # Redis נפל: ממשיכים בזיכרון, שם הנעילה המקומית מספיקה
+                redis_failed(e)
+        held.add(self.code)
+        return self
+
+    def release(self):
+        if self._nested:
+            return
+        _trip_locks_held.codes.discard(self.code)
+        try:
+            if self._rc is not None:
+                self._redis_unlock()
+        finally:
+            self._local.release()
+
+    def _redis_unlock(self):
+        from redis.exceptions import ResponseError, WatchError
+        key = trip_lock_key(self.code)
+        try:
+            try:
+                self._rc.eval(_UNLOCK_LUA, 1, key, self._token)
+            except ResponseError:
+                # שרת בלי scripting — אותה בדיקה עם WATCH
+                with self._rc.pipeline() as pipe:
+                    pipe.watch(key)
+                    if pipe.get(key) == self._token:
+                        pipe.multi()
+                        pipe.delete(key)
+                        pipe.execute()
+        except WatchError:
+            pass
+        except Exception as e:
+            log.warning("Redis unlock failed for trip %s: %s", self.code, e)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
 
 def ensure_self_trip(num):
     code = f"SELF:{num}"
@@ -227,8 +620,9 @@ def detect_currency_from_text(text: str, default_cur: str):
     if "€" in t: return "EUR"
     if "$" in t: return "USD"
     if "₪" in t or 'ש"ח' in t or "שח" in t: return "ILS"
-    for k, v in ALIASES.items():
-        if k in t.lower(): return v
+    tl = t.lower()
+    for k, v in ALIAS_ITEMS:
+        if k in tl: return v
     return default_cur
 
 def detect_target_currency(text: str):
@@ -242,7 +636,7 @@ def detect_target_currency(text: str):
     return None
 
 def parse_first_amount(text: str):
-    m = re.search(r"(\d[\d,\.]*)", text)
+    m = RE_AMOUNT.search(text)
     if not m: raise ValueError("no number")
     raw = m.group(1).replace(",", "")
     return int(round(float(raw)))
@@ -267,7 +661,7 @@ def fmt(amount_ils: int, st):
 
 def guess_category(description: str):
     d = (description or "").lower()
-    for kw, cat in CATEGORY_MAP.items():
+    for kw, cat in CATEGORY_ITEMS:
         if kw in d: return cat
     return "אחר"
 
@@ -278,7 +672,35 @@ def short_phone(p):
 def display_name(phone, st):
     return st.get("names", {}).get(phone) or short_phone(phone)
 
+# ===== Warmup (per worker process) =====
+_warm_lock = threading.Lock()
+_warm_pid = None
+
+def _warm_background():
+    redis_client()
+    get_rates()
+
+def warmup():
+    """
+    Per-process warmup: gunicorn's post_worker_init hook, or the first request.
+    Connecting to Redis and fetching FX rates happen in a background thread
+    so a slow Redis never delays worker boot; also starts the archiver.
+    """
+    global _warm_pid
+    with _warm_lock:
+        if _warm_pid == os.getpid():
+            return
+        _warm_pid = os.getpid()
+    if not REDIS_URL:
+        log.warning("REDIS_URL not set; falling back to in-memory state ⚠️")
+    threading.Thread(target=_warm_background, name="warmup", daemon=True).start()
+    start_archiver()
+
 # ===== Routes =====
+@app.before_request
+def _ensure_warm():
+    warmup()
+
 @app.route("/", methods=["GET"])
 def home():
     return "Budget Queen WhatsApp Bot - OK", 200
@@ -288,23 +710,7 @@ def whatsapp():
     if request.method == "GET":
         return "Webhook is ready", 200
 
-    # keep Redis alive (reconnect if needed)
-    global r, USE_REDIS
-    if r is not None:
-        try:
-            r.ping()
-        except Exception:
-            try:
-                from redis import Redis
-                r = Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True,
-                                    socket_connect_timeout=5, socket_timeout=5,
-                                    health_check_interval=30, retry_on_timeout=True)
-                r.ping()
-                USE_REDIS = True
-            except Exception:
-                log.warning("Redis temporarily unavailable; continuing in-memory")
-                USE_REDIS = False
-
+    lock = None
     try:
         from_number = request.form.get("From", "")
         body_raw = (request.form.get("Body") or "").strip()
@@ -312,8 +718,9 @@ def whatsapp():
         if not from_number:
             abort(400)
 
-        # load user & active trip
+        # load user & active trip — the trip stays locked until the reply is sent
         user = load_user(from_number)
+        lock = TripLock(user.get("active_trip") or f"SELF:{from_number}").acquire()
         active_code = user.get("active_trip")
         if not active_code or active_code.startswith("SELF:"):
             active_code, st = ensure_self_trip(from_number)
@@ -325,6 +732,12 @@ def whatsapp():
                 active_code, st = ensure_self_trip(from_number)
                 user["active_trip"] = active_code
                 save_user(from_number, user)
+        if active_code != lock.code:
+            # הקבוצה לא נמצאה וחזרנו לטיול האישי — נועלים אותו במקום
+            lock.release()
+            lock = None
+            lock = TripLock(active_code).acquire()
+            active_code, st = ensure_self_trip(from_number)
 
         expenses = st["expenses"]
         st.setdefault("names", {})
@@ -352,7 +765,7 @@ def whatsapp():
             )
 
         if text.startswith("פתח קבוצה"):
-            name = re.sub(r"^פתח קבוצה[:\s]*", "", body_raw).strip() or "טיול"
+            name = RE_OPEN_GROUP_PREFIX.sub("", body_raw).strip() or "טיול"
             code = random_code()
             new_st = default_state() # <--- כאן יתבצע ניסיון משיכת שערים
             new_st["destination"] = name
@@ -370,21 +783,22 @@ def whatsapp():
             )
 
         if text.startswith("הצטרף"):
-            m = re.search(r"\b([A-Za-z0-9]{4,10})\b", body_raw)
+            m = RE_TRIP_CODE.search(body_raw)
             if not m: return tw_reply("לא הבנתי את הקוד 😅 נסי: 'הצטרף ABC123'")
             code = m.group(1).upper()
             if not trip_exists(code): return tw_reply("הקוד לא נמצא 🤔")
-            st2 = load_trip(code)
-            st2.setdefault("members", [])
-            if from_number not in st2["members"]:
-                st2["members"].append(from_number)
-                save_trip(code, st2)
+            with TripLock(code):
+                st2 = load_trip(code)
+                st2.setdefault("members", [])
+                if from_number not in st2["members"]:
+                    st2["members"].append(from_number)
+                    save_trip(code, st2)
             user["active_trip"] = code
             save_user(from_number, user)
             return tw_reply(f"✨ הצטרפת! יעד: {st2.get('destination') or 'ללא'}\nחברי קבוצה: {len(st2['members'])}\nאפשר להגדיר תקציב/להוסיף הוצאות כרגיל.")
 
         if text.startswith("החלף קבוצה"):
-            m = re.search(r"\b([A-Za-z0-9]{4,10})\b", body_raw)
+            m = RE_TRIP_CODE.search(body_raw)
             if not m: return tw_reply("לא הבנתי את הקוד 😅 נסי: 'החלף קבוצה ABC123'")
             code = m.group(1).upper()
             if not trip_exists(code): return tw_reply("הקוד לא נמצא 🤔")
@@ -413,7 +827,7 @@ def whatsapp():
             return tw_reply(f"נעים להכיר {name}! 🥰 נשמור את זה לסיכומים.")
 
         if text.startswith("שם "):
-            m = re.match(r"שם\s+(\+?\d+)\s*:\s*(.+)$", body_raw)
+            m = RE_NAME_FOR_NUMBER.match(body_raw)
             if m:
                 num, name = m.group(1), m.group(2).strip()
                 st["names"]["whatsapp:"+num if not num.startswith("whatsapp:") else num] = name
@@ -423,7 +837,7 @@ def whatsapp():
         if text.startswith("שמות"):
             try:
                 rhs = body_raw.split(":", 1)[1]
-                given = [s.strip() for s in re.split(r"[,\n]", rhs) if s.strip()]
+                given = [s.strip() for s in RE_LIST_SPLIT.split(rhs) if s.strip()]
                 if not given: raise ValueError()
                 members = st.get("members", [])
                 for i, mbr in enumerate(members):
@@ -460,10 +874,11 @@ def whatsapp():
         if text.startswith("שער"):
             try:
                 rhs = body_raw.split(":", 1)[1]
-                pairs = re.findall(r"(USD|EUR|ILS)\s*=\s*([\d\.]+)", rhs, re.IGNORECASE)
+                pairs = RE_RATE_PAIRS.findall(rhs)
                 if not pairs: raise ValueError()
                 for cur, rate in pairs:
                     st["rates"][cur.upper()] = float(rate)
+                st["rates_custom"] = True
                 save_trip(active_code, st)
                 # מעגלים את התצוגה ל-3 ספרות אחרי הנקודה
                 usd_rate = round(st['rates']['USD'], 3)
@@ -474,7 +889,7 @@ def whatsapp():
 
         if text.startswith("יעד"):
             try:
-                dest = re.sub(r"^יעד[:\s]*", "", body_raw, flags=re.IGNORECASE).strip()
+                dest = RE_DEST_PREFIX.sub("", body_raw).strip()
                 if not dest: raise ValueError()
                 st["destination"] = dest
                 save_trip(active_code, st)
@@ -484,7 +899,7 @@ def whatsapp():
 
         if text.startswith("תקציב"):
             try:
-                val_part = re.sub(r"^תקציב[:\s]*", "", body_raw, flags=re.IGNORECASE).strip()
+                val_part = RE_BUDGET_PREFIX.sub("", body_raw).strip()
                 cur = detect_currency_from_text(val_part, st["display_currency"])
                 amount = parse_first_amount(val_part)
                 amount_ils = to_ils(amount, cur, st["rates"])
@@ -522,11 +937,11 @@ def whatsapp():
 
             def norm(s):
                 s = s.lower()
-                s = re.sub(r"[^\w\u0590-\u05FF ]+", " ", s)
-                s = re.sub(r"\s+", " ", s).strip()
+                s = RE_NORM_PUNCT.sub(" ", s)
+                s = RE_SPACES.sub(" ", s).strip()
                 return s
 
-            if re.fullmatch(r"\d+", q):
+            if RE_DIGITS.fullmatch(q):
                 idx = int(q) - 1
                 if 0 <= idx < len(expenses):
                     it = expenses.pop(idx)
@@ -602,7 +1017,7 @@ def whatsapp():
 
         if text.startswith("עדכן"):
             try:
-                nums = re.findall(r"(\d[\d,\.]*)", body_raw)
+                nums = RE_AMOUNT.findall(body_raw)
                 if len(nums) < 2: raise ValueError()
                 old_amt = int(round(float(nums[0].replace(",", ""))))
                 new_amt = int(round(float(nums[1].replace(",", ""))))
@@ -653,15 +1068,15 @@ def whatsapp():
             if st["budget"] == 0:
                 return tw_reply("📝 קודם מגדירות תקציב, סיס! נסי: תקציב 3000 או תקציב $2000")
             try:
-                cleaned = re.sub(r"^הוצאה[:\s]*", "", body_raw, flags=re.IGNORECASE).strip()
-                m = re.search(r"(\d[\d,\.]*)", cleaned)
+                cleaned = RE_EXPENSE_PREFIX.sub("", body_raw).strip()
+                m = RE_AMOUNT.search(cleaned)
                 if not m: raise ValueError("no number")
                 num_span_end = m.end()
                 cur = detect_currency_from_text(cleaned, st["display_currency"])
                 amt = parse_first_amount(cleaned)
                 amt_ils = to_ils(amt, cur, st["rates"])
                 desc = cleaned[num_span_end:].strip()
-                desc = re.sub(r"^[\s\-–:.,]*(דולר|יורו|אירו|שקל|ש\"ח|₪|\$|€)?[\s\-–:.,]*", "", desc, flags=re.IGNORECASE)
+                desc = RE_DESC_CURRENCY.sub("", desc)
                 if not desc:
                     desc = "הוצאה"
                 cat = guess_category(desc)
@@ -687,6 +1102,9 @@ def whatsapp():
     except Exception as e:
         log.exception("Unhandled error in /whatsapp: %s", e)
         return tw_reply("אופס, קרתה תקלה רגעית 😅 נסי שוב עוד שניה.\nאם זה חוזר—שלחי 'סיכום' לוודא שהכל שמור 🙏")
+    finally:
+        if lock is not None:
+            lock.release()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 3000))
@@ -0,0 +1,22 @@
+# Gunicorn config (loaded automatically from the working directory).
+# Threaded workers: a webhook mostly waits on Redis / Twilio / the FX API,
+# so one worker process can serve many of them at once.
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# gthread only: the app's locks are created at import in the (preloaded)
+# master, so they would stay native under gevent's monkey-patching.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+keepalive = 5
+
+# Import app.py once in the master; the import no longer touches Redis or the
+# network, so forking from it is safe and workers boot immediately.
+preload_app = True
+
+
+def post_worker_init(worker):
+    # Redis client, FX cache and the archiver thread are per process.
+    import app as budget_queen
+    budget_queen.warmup()